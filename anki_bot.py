@@ -5,33 +5,127 @@ Sends scheduled reminders for Anki practice and article homework
 """
 
 import asyncio
+import hashlib
+import itertools
 import json
 import logging
 import os
+import queue
 import random
 import signal
+import sqlite3
 import sys
-from datetime import datetime, time
-from typing import List
-import pytz
-from telegram import Bot, Update
-from telegram.ext import Application, MessageHandler, filters
+import time
+from collections import OrderedDict, deque
+from contextlib import closing
+from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Iterator, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+from telegram import InputFile, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, MessageHandler, TypeHandler, filters
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
-# Configure logging
+# Configure logging - records are queued and written to file/console
+# by a background listener so logging never blocks the event loop
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    RotatingFileHandler('anki_bot.log', maxBytes=1_000_000, backupCount=3),
+    logging.StreamHandler()
+]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
+queue_handler = QueueHandler(log_queue)
+# Only merge the message arguments here; the listener's handlers add the prefix
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
-    handlers=[
-        logging.FileHandler('anki_bot.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[queue_handler]
 )
 logger = logging.getLogger(__name__)
 
+# All schedules and completion dates use Moscow time
+MOSCOW_TZ = ZoneInfo('Europe/Moscow')
+
+# Anki reminder messages
+REMINDER_MESSAGES = (
+    "Time for your Anki flashcards! 📚✨",
+    "Hey! Don't forget your daily Anki practice! 🧠💪",
+    "Anki time! Let's strengthen that memory! 🎯",
+    "Your brain is waiting for some Anki love! 💝📖",
+    "Daily Anki reminder: Knowledge is power! ⚡📚",
+    "Ready to boost your brain? Anki awaits! 🚀🧠",
+    "Don't let your neurons get lazy! Anki time! ⚡📖",
+    "Consistency is the key to mastery! Time for Anki! 🔑",
+    "Level up your knowledge with today's Anki session! 🎮",
+    "Your future self will thank you for this Anki session! 🙏",
+)
+
+FOLLOWUP_MESSAGES = (
+    "Still waiting for your Anki screenshot! Don't give up! 💪",
+    "Hey, did you forget about Anki? It's not too late! ⏰",
+    "Your brain is still waiting for that Anki session! 🧠❤️",
+    "Gentle reminder: Anki flashcards are still pending! 📚",
+    "Don't let the day end without your Anki practice! 🌙",
+    "Last chance to complete your daily Anki goal! 🎯",
+    "Even 5 minutes of Anki is better than none! ⚡",
+)
+
+CONGRATULATION_MESSAGES = (
+    "🎉 Excellent work! Your dedication to Anki is paying off! 🌟",
+    "👏 Amazing job! Another day, another step towards mastery! 💪",
+    "🔥 Fantastic! Your consistency is inspiring! Keep it up! 🚀",
+    "⭐ Well done! Your brain is getting stronger every day! 🧠💪",
+    "🎯 Perfect! You're building such a great habit! 👍",
+    "💎 Outstanding! Your future self is already thanking you! 🙏",
+    "🌟 Brilliant work! Knowledge is your superpower! ⚡",
+    "🎊 Awesome! Another successful Anki session completed! 📚✨",
+    "👑 Champion! Your dedication to learning is admirable! 🏆",
+    "🔥 Incredible! You're on fire with your Anki practice! 🚀",
+)
+
+# Article homework reminder messages (20 advanced CEFR variations)
+ARTICLE_MESSAGES = (
+    "📖 It's time to get the ball rolling and hit the article for homework! 🚀",
+    "📚 Don't put it off any longer—roll up your sleeves, get down to work, and tackle that article! 💪",
+    "🎯 Time to buckle down and dive into today's reading assignment! 📰",
+    "✨ Don't let this slip through the cracks—seize the moment and delve into that article! 🔍",
+    "🧠 No more dragging your feet! It's time to knuckle down and absorb that content! 📖",
+    "⚡ Strike while the iron is hot—jump into your article and broaden your horizons! 🌍",
+    "📝 Don't beat around the bush—cut to the chase and immerse yourself in the reading! 🎓",
+    "🎪 Time to step up to the plate and devour that article with enthusiasm! 📚",
+    "🔥 No time like the present to crack on with your homework and expand your knowledge! 💡",
+    "🌟 Let's get cracking! Plunge into the article and sharpen those critical thinking skills! 🧐",
+    "💼 Time to pull your socks up and digest the insights from today's assigned reading! 📖",
+    "🚀 Don't drag your heels—launch yourself into the article and reap the rewards! 🏆",
+    "📚 Bite the bullet and tackle that reading head-on—your future self will thank you! 🙏",
+    "🎯 Time to hit the ground running and absorb every nugget of wisdom in that piece! 💎",
+    "⏰ The clock's ticking! Seize the day and engross yourself in the article! 📰",
+    "🌈 Don't dilly-dally—embark on your reading journey and unlock new perspectives! 🗝️",
+    "💪 Time to buckle down and grapple with the complexities of today's article! 🧠",
+    "📖 Don't let this slide—sink your teeth into the material and extract maximum value! 🍊",
+    "🎓 No more procrastinating! Zero in on the article and elevate your understanding! ⬆️",
+    "✨ Time to press on and scrutinize the article with fresh eyes and an open mind! 👀",
+)
+
+# Prefix for the reminder sent on startup
+TEST_REMINDER_PREFIX = "🧪 Test reminder: "
+
+# Image paths
+IMAGE_PATHS = (
+    "./vasilina_anki_1.png",
+    "./vasilina_anki_2.png",
+    "./vasilina_anki_3.png",
+    "./vasilina_anki_4.png",
+    "./vasilina_anki_5.png",
+)
+
 class SimpleAnkiBot:
-    def __init__(self):
+    def __init__(self, seed: Optional[int] = None, monitor_images: bool = True):
         # Configuration - Get from environment variables
         self.token = os.getenv('TELEGRAM_TOKEN')
         chat_id_str = os.getenv('CHAT_ID')
@@ -47,13 +141,47 @@ class SimpleAnkiBot:
         except ValueError:
             raise ValueError("CHAT_ID must be a valid integer")
         
-        self.bot = Bot(token=self.token)
+        # Whether to poll Telegram for the student's screenshots; without it the
+        # bot only sends scheduled reminders
+        self.monitor_images = monitor_images
+        
+        # Own random generator, seedable for reproducible message choices
+        self._rng = random.Random(seed)
+        
+        # Go through each message pool in a shuffled order so messages don't
+        # repeat until all of them have been used
+        self._reminder_cycle = self.shuffled_cycle(REMINDER_MESSAGES)
+        self._followup_cycle = self.shuffled_cycle(FOLLOWUP_MESSAGES)
+        self._congratulation_cycle = self.shuffled_cycle(CONGRATULATION_MESSAGES)
+        
+        # Saved Telegram state is tied to this bot (the part of the token before the colon)
+        self.bot_id = self.token.split(':', 1)[0]
+        
+        # Set on shutdown signals to let start_bot return
+        self._shutdown_event = asyncio.Event()
+        
+        # Set in start_bot to the Application's bot, sharing its connection pool
+        self.bot = None
         self.application = None
-        self.scheduler = AsyncIOScheduler(timezone=pytz.timezone('Europe/Moscow'))
-        self.moscow_tz = pytz.timezone('Europe/Moscow')
+        # Run a late job once (up to an hour late) instead of skipping or repeating it
+        self.scheduler = AsyncIOScheduler(
+            timezone=MOSCOW_TZ,
+            job_defaults={'coalesce': True, 'misfire_grace_time': 3600, 'max_instances': 1}
+        )
         
         # Persistent storage for completion status
-        self.status_file = 'completion_status.json'
+        self.status_db = 'completion_status.db'
+        self.legacy_status_file = 'completion_status.json'
+        self.status_retention_days = 90
+        # Completed dates are kept in memory; the database is only written on change
+        self._completed = self.load_completion_status()
+        
+        # Last acknowledged Telegram update, so restarts don't replay old updates
+        self.offset_file = 'telegram_offset.json'
+        # Telegram may restart update ids at a random value after a week without
+        # updates, so an older saved offset could skip newer pending updates
+        self.max_offset_age = timedelta(days=7)
+        self._offset_lock = asyncio.Lock()
         
         # ====== ARTICLE HOMEWORK LINK ======
         # Can be set via Railway environment variable ARTICLE_LINK
@@ -61,257 +189,374 @@ class SimpleAnkiBot:
         self.article_link = os.getenv('ARTICLE_LINK', "https://example.com/article")
         # ===================================
         
-        # Anki reminder messages
-        self.reminder_messages = [
-            "Time for your Anki flashcards! 📚✨",
-            "Hey! Don't forget your daily Anki practice! 🧠💪",
-            "Anki time! Let's strengthen that memory! 🎯",
-            "Your brain is waiting for some Anki love! 💝📖",
-            "Daily Anki reminder: Knowledge is power! ⚡📚",
-            "Ready to boost your brain? Anki awaits! 🚀🧠",
-            "Don't let your neurons get lazy! Anki time! ⚡📖",
-            "Consistency is the key to mastery! Time for Anki! 🔑",
-            "Level up your knowledge with today's Anki session! 🎮",
-            "Your future self will thank you for this Anki session! 🙏"
-        ]
-        
-        self.followup_messages = [
-            "Still waiting for your Anki screenshot! Don't give up! 💪",
-            "Hey, did you forget about Anki? It's not too late! ⏰",
-            "Your brain is still waiting for that Anki session! 🧠❤️",
-            "Gentle reminder: Anki flashcards are still pending! 📚",
-            "Don't let the day end without your Anki practice! 🌙",
-            "Last chance to complete your daily Anki goal! 🎯",
-            "Even 5 minutes of Anki is better than none! ⚡"
-        ]
-        
-        self.congratulation_messages = [
-            "🎉 Excellent work! Your dedication to Anki is paying off! 🌟",
-            "👏 Amazing job! Another day, another step towards mastery! 💪",
-            "🔥 Fantastic! Your consistency is inspiring! Keep it up! 🚀",
-            "⭐ Well done! Your brain is getting stronger every day! 🧠💪",
-            "🎯 Perfect! You're building such a great habit! 👍",
-            "💎 Outstanding! Your future self is already thanking you! 🙏",
-            "🌟 Brilliant work! Knowledge is your superpower! ⚡",
-            "🎊 Awesome! Another successful Anki session completed! 📚✨",
-            "👑 Champion! Your dedication to learning is admirable! 🏆",
-            "🔥 Incredible! You're on fire with your Anki practice! 🚀"
-        ]
-        
-        # Article homework reminder messages (20 advanced CEFR variations)
-        self.article_messages = [
-            "📖 It's time to get the ball rolling and hit the article for homework! 🚀",
-            "📚 Don't put it off any longer—roll up your sleeves, get down to work, and tackle that article! 💪",
-            "🎯 Time to buckle down and dive into today's reading assignment! 📰",
-            "✨ Don't let this slip through the cracks—seize the moment and delve into that article! 🔍",
-            "🧠 No more dragging your feet! It's time to knuckle down and absorb that content! 📖",
-            "⚡ Strike while the iron is hot—jump into your article and broaden your horizons! 🌍",
-            "📝 Don't beat around the bush—cut to the chase and immerse yourself in the reading! 🎓",
-            "🎪 Time to step up to the plate and devour that article with enthusiasm! 📚",
-            "🔥 No time like the present to crack on with your homework and expand your knowledge! 💡",
-            "🌟 Let's get cracking! Plunge into the article and sharpen those critical thinking skills! 🧐",
-            "💼 Time to pull your socks up and digest the insights from today's assigned reading! 📖",
-            "🚀 Don't drag your heels—launch yourself into the article and reap the rewards! 🏆",
-            "📚 Bite the bullet and tackle that reading head-on—your future self will thank you! 🙏",
-            "🎯 Time to hit the ground running and absorb every nugget of wisdom in that piece! 💎",
-            "⏰ The clock's ticking! Seize the day and engross yourself in the article! 📰",
-            "🌈 Don't dilly-dally—embark on your reading journey and unlock new perspectives! 🗝️",
-            "💪 Time to buckle down and grapple with the complexities of today's article! 🧠",
-            "📖 Don't let this slide—sink your teeth into the material and extract maximum value! 🍊",
-            "🎓 No more procrastinating! Zero in on the article and elevate your understanding! ⬆️",
-            "✨ Time to press on and scrutinize the article with fresh eyes and an open mind! 👀"
-        ]
-
-        # Image paths
-        self.image_paths = [
-            "./vasilina_anki_1.png",
-            "./vasilina_anki_2.png",
-            "./vasilina_anki_3.png",
-            "./vasilina_anki_4.png",
-            "./vasilina_anki_5.png"
-        ]
+        # Preload image bytes; a daily job refreshes them from disk
+        self.set_image_cache(self.load_images())
+        
+        # Telegram file_ids of uploaded images keyed by content hash, reused
+        # instead of re-uploading and kept across restarts. file_ids are only
+        # valid for the bot that uploaded them, so they are stored per bot id
+        self.file_ids_file = 'telegram_file_ids.json'
+        self._file_ids = self.load_file_ids()
         
         # Track which article message was last used
         self.article_message_index = 0
+        
+        # Timestamps of recent sends, to stay under Telegram's per-chat limit
+        self.max_sends_per_minute = 20
+        self.min_send_interval = 1.05
+        self._send_times = deque(maxlen=self.max_sends_per_minute)
+        self._send_lock = asyncio.Lock()
+        
+        # Recently handled message ids, to ignore redelivered updates
+        self._processed_message_ids = OrderedDict()
+        self.max_processed_message_ids = 1000
+
+    def shuffled_cycle(self, messages: Tuple[str, ...]) -> Iterator[str]:
+        """Endlessly repeat the messages in one random order"""
+        return itertools.cycle(self._rng.sample(messages, len(messages)))
 
-    def load_completion_status(self):
-        """Load completion status from file - with better error handling"""
+    def load_completion_status(self) -> Set[str]:
+        """Load completed dates from the database - with error handling"""
         try:
-            with open(self.status_file, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logger.warning(f"Could not load status file ({e}), starting fresh")
-            return {}
+            with closing(sqlite3.connect(self.status_db, isolation_level=None)) as db:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('CREATE TABLE IF NOT EXISTS completed (date TEXT PRIMARY KEY)')
+                self.import_legacy_status(db)
+                
+                # Apply the retention on load too, so old or imported days don't linger
+                cutoff = self.get_status_cutoff()
+                db.execute('DELETE FROM completed WHERE date < ?', (cutoff,))
+                return {row[0] for row in db.execute('SELECT date FROM completed')}
+        except sqlite3.Error as e:
+            logger.warning("Could not load status database (%s), starting fresh", e)
+            return set()
+
+    def get_status_cutoff(self) -> str:
+        """Get the oldest date kept in the completion status"""
+        today = self.get_moscow_time().date()
+        return (today - timedelta(days=self.status_retention_days)).isoformat()
 
-    def save_completion_status(self, status):
-        """Save completion status to file - with error handling"""
+    def import_legacy_status(self, db: sqlite3.Connection):
+        """Move completed dates from the old JSON status file into the database"""
         try:
-            with open(self.status_file, 'w') as f:
-                json.dump(status, f)
-        except Exception as e:
-            logger.error(f"Failed to save status: {e}")
+            with open(self.legacy_status_file, 'r') as f:
+                status = json.load(f)
+            days = [(day,) for day, done in status.items() if done]
+        except FileNotFoundError:
+            return
+        except (OSError, json.JSONDecodeError, AttributeError) as e:
+            logger.warning("Could not import legacy status file (%s)", e)
+            return
+        
+        changes_before = db.total_changes
+        db.executemany('INSERT OR IGNORE INTO completed (date) VALUES (?)', days)
+        imported = db.total_changes - changes_before
+        
+        try:
+            os.replace(self.legacy_status_file, self.legacy_status_file + '.imported')
+        except OSError as e:
+            logger.warning("Could not rename legacy status file (%s)", e)
+        logger.info("💾 Imported %s days from %s", imported, self.legacy_status_file)
+
+    def save_completion_status(self, day: str, cutoff: str):
+        """Record a completed day and drop days before the cutoff - with error handling"""
+        try:
+            with closing(sqlite3.connect(self.status_db, isolation_level=None)) as db:
+                db.execute('INSERT OR IGNORE INTO completed (date) VALUES (?)', (day,))
+                db.execute('DELETE FROM completed WHERE date < ?', (cutoff,))
+        except sqlite3.Error as e:
+            logger.error("Failed to save status: %s", e)
 
     def is_completed_today(self) -> bool:
-        """Check if task was completed today using persistent storage"""
+        """Check if task was completed today using the in-memory status"""
         current_date = self.get_moscow_time().date().isoformat()
-        status = self.load_completion_status()
-        return status.get(current_date, False)
+        return current_date in self._completed
 
-    def mark_completed_today(self):
-        """Mark today as completed in persistent storage"""
+    async def mark_completed_today(self):
+        """Mark today as completed and write through to persistent storage"""
         current_date = self.get_moscow_time().date().isoformat()
-        status = self.load_completion_status()
-        status[current_date] = True
-        self.save_completion_status(status)
-        logger.info(f"✅ Marked {current_date} as completed in persistent storage")
+        self._completed.add(current_date)
+        
+        # Only keep recent days so the database doesn't grow forever
+        cutoff = self.get_status_cutoff()
+        self._completed = {day for day in self._completed if day >= cutoff}
+        await asyncio.to_thread(self.save_completion_status, current_date, cutoff)
+        logger.info("✅ Marked %s as completed in persistent storage", current_date)
+
+    def load_update_offset(self) -> Optional[int]:
+        """Load the next Telegram update offset saved before the last restart"""
+        try:
+            with open(self.offset_file, 'r') as f:
+                saved = json.load(f)
+            if saved.get('bot_id') != self.bot_id:
+                logger.info("⏩ Saved update offset belongs to another bot, ignoring it")
+                return None
+            age = time.time() - float(saved['saved_at'])
+            if age > self.max_offset_age.total_seconds():
+                logger.info("⏩ Saved update offset is too old, ignoring it")
+                return None
+            return int(saved['offset'])
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning("Could not load offset file (%s), starting fresh", e)
+            return None
+
+    def save_update_offset(self, offset: int):
+        """Save the next Telegram update offset - with error handling"""
+        try:
+            with open(self.offset_file, 'w') as f:
+                json.dump({'bot_id': self.bot_id, 'offset': offset, 'saved_at': time.time()}, f)
+        except Exception as e:
+            logger.error("Failed to save update offset: %s", e)
+
+    async def record_update_offset(self, update: Update, context):
+        """Persist the offset after every incoming update"""
+        # Updates are handled concurrently; the lock is FIFO, so writes happen
+        # in the order the updates arrived
+        async with self._offset_lock:
+            await asyncio.to_thread(self.save_update_offset, update.update_id + 1)
+
+    def load_images(self) -> Dict[str, Tuple[bytes, str]]:
+        """Read all existing images into memory along with their SHA-256 digests"""
+        cache = {}
+        for img in IMAGE_PATHS:
+            try:
+                with open(img, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            cache[img] = (data, hashlib.sha256(data).hexdigest())
+        return cache
+
+    def set_image_cache(self, image_cache: Dict[str, Tuple[bytes, str]]):
+        """Use the given image bytes and digests for all following sends"""
+        self._image_cache = {img: data for img, (data, _) in image_cache.items()}
+        self._image_digests = {img: digest for img, (_, digest) in image_cache.items()}
+        self._available_images = tuple(image_cache)
+
+    async def refresh_images(self):
+        """Re-read and hash images in a worker thread so added or replaced files are picked up"""
+        self.set_image_cache(await asyncio.to_thread(self.load_images))
+        logger.info("📸 Image cache refreshed: %s images", len(self._available_images))
+
+    def load_file_ids(self) -> Dict[str, str]:
+        """Load file_ids of images uploaded before the last restart"""
+        try:
+            with open(self.file_ids_file, 'r') as f:
+                saved = json.load(f)
+            if saved.get('bot_id') != self.bot_id:
+                logger.info("📸 Saved file_ids belong to another bot, starting fresh")
+                return {}
+            return dict(saved['file_ids'])
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning("Could not load file_ids file (%s), starting fresh", e)
+            return {}
+
+    def save_file_ids(self, file_ids: Dict[str, str]):
+        """Save file_ids of uploaded images - with error handling"""
+        try:
+            with open(self.file_ids_file, 'w') as f:
+                json.dump({'bot_id': self.bot_id, 'file_ids': file_ids}, f)
+        except Exception as e:
+            logger.error("Failed to save file_ids: %s", e)
 
-    def get_available_images(self) -> List[str]:
-        """Get list of available images"""
-        return [img for img in self.image_paths if os.path.exists(img)]
+    def get_available_images(self) -> Tuple[str, ...]:
+        """Get list of available images (cached, refreshed daily)"""
+        return self._available_images
+
+    def pick_image(self) -> Optional[str]:
+        """Pick a random available image, or None if there are none"""
+        available_images = self._available_images
+        return self._rng.choice(available_images) if available_images else None
+
+    async def send_rate_limited(self, send, **kwargs):
+        """Call a Telegram send method, pacing sends and honouring RetryAfter"""
+        async with self._send_lock:
+            # Wait until the oldest send has left the one-minute window
+            if len(self._send_times) == self.max_sends_per_minute:
+                delay = 60 - (time.monotonic() - self._send_times[0])
+                if delay > 0:
+                    logger.info("⏳ Rate limit reached, waiting %.1fs", delay)
+                    await asyncio.sleep(delay)
+            
+            # Keep back-to-back sends at least a second apart
+            if self._send_times:
+                delay = self.min_send_interval - (time.monotonic() - self._send_times[-1])
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            
+            try:
+                result = await send(chat_id=self.chat_id, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning("⏳ Flood control exceeded, retrying in %ss", retry_after)
+                await asyncio.sleep(retry_after + 0.5)
+                result = await send(chat_id=self.chat_id, **kwargs)
+            
+            self._send_times.append(time.monotonic())
+            return result
 
     async def send_message_with_image(self, message: str, image_path: str = None):
         """Send message with optional image - with fallback"""
         try:
-            if image_path and os.path.exists(image_path):
-                with open(image_path, 'rb') as photo:
-                    await self.bot.send_photo(
-                        chat_id=self.chat_id,
-                        photo=photo,
+            if image_path in self._image_cache:
+                # Reuse the Telegram file_id after the first upload
+                digest = self._image_digests[image_path]
+                file_id = self._file_ids.get(digest)
+                sent = None
+                if file_id is not None:
+                    try:
+                        sent = await self.send_rate_limited(
+                            self.bot.send_photo,
+                            photo=file_id,
+                            caption=message
+                        )
+                    except BadRequest as e:
+                        # Telegram no longer accepts this file_id - forget it and upload again
+                        logger.warning("Cached file_id rejected (%s), re-uploading image", e)
+                        self._file_ids.pop(digest, None)
+                        await asyncio.to_thread(self.save_file_ids, dict(self._file_ids))
+                
+                if sent is None:
+                    sent = await self.send_rate_limited(
+                        self.bot.send_photo,
+                        photo=InputFile(
+                            self._image_cache[image_path],
+                            filename=os.path.basename(image_path)
+                        ),
                         caption=message
                     )
-                logger.info(f"Message sent with image: {os.path.basename(image_path)}")
-            else:
-                # FALLBACK: Send text only if image missing
-                await self.bot.send_message(chat_id=self.chat_id, text=message)
-                logger.info("Message sent (text only - image not available)")
+                    if sent.photo:
+                        self._file_ids[digest] = sent.photo[-1].file_id
+                        await asyncio.to_thread(self.save_file_ids, dict(self._file_ids))
+                logger.info("Message sent with image: %s", os.path.basename(image_path))
+                return
+            
+            # FALLBACK: Send text only if image missing
+            await self.send_rate_limited(self.bot.send_message, text=message)
+            logger.info("Message sent (text only - image not available)")
                 
         except Exception as e:
-            logger.error(f"Error sending message with image: {e}")
+            logger.error("Error sending message with image: %s", e)
             # FALLBACK: Try text only
             try:
-                await self.bot.send_message(chat_id=self.chat_id, text=message)
+                await self.send_rate_limited(self.bot.send_message, text=message)
                 logger.info("Message sent as text after image failure")
             except Exception as e2:
-                logger.error(f"Complete failure sending message: {e2}")
+                logger.error("Complete failure sending message: %s", e2)
 
     async def send_text_message(self, message: str):
         """Send a text-only message"""
         try:
-            await self.bot.send_message(
-                chat_id=self.chat_id,
+            await self.send_rate_limited(
+                self.bot.send_message,
                 text=message
             )
             logger.info("Text message sent")
         except Exception as e:
-            logger.error(f"Error sending text message: {e}")
+            logger.error("Error sending text message: %s", e)
 
     def get_moscow_time(self) -> datetime:
         """Get current Moscow time"""
-        return datetime.now(self.moscow_tz)
+        return datetime.now(MOSCOW_TZ)
 
     async def handle_image_message(self, update: Update, context):
         """Handle incoming image messages"""
         try:
-            # Only process messages from the target chat
-            if update.effective_chat.id != self.chat_id:
-                logger.info(f"❌ Message from wrong chat: {update.effective_chat.id}")
-                return
-            
             # Check if message contains a photo
             if not update.message.photo:
                 logger.info("❌ Message doesn't contain photo")
                 return
-                
-            current_time = self.get_moscow_time()
-            current_date = current_time.date()
             
-            logger.info(f"📸 Image received at {current_time}")
-            
-            # Check if already completed today using persistent storage
+            # Only the first screenshot of the day counts - skip all other work after it
             if self.is_completed_today():
                 logger.info("✅ Task already completed today - ignoring duplicate")
                 return
             
-            # Mark task as completed for today in persistent storage
-            self.mark_completed_today()
-            logger.info(f"✅ Marked {current_date} as completed")
+            # Ignore updates Telegram delivers more than once
+            message_id = update.message.message_id
+            if message_id in self._processed_message_ids:
+                logger.info("🔁 Message %s already processed - ignoring", message_id)
+                return
+            self._processed_message_ids[message_id] = None
+            if len(self._processed_message_ids) > self.max_processed_message_ids:
+                self._processed_message_ids.popitem(last=False)
+                
+            current_time = self.get_moscow_time()
+            current_date = current_time.date()
+            
+            logger.info("📸 Image received at %s", current_time)
+            
+            # Claim today in memory before the first await, so a concurrent photo
+            # update can't also get past the check above; then persist it
+            self._completed.add(current_date.isoformat())
+            await self.mark_completed_today()
+            logger.info("✅ Marked %s as completed", current_date)
             
             # Send congratulation message
-            congratulation = random.choice(self.congratulation_messages)
-            available_images = self.get_available_images()
-            image_path = random.choice(available_images) if available_images else None
+            congratulation = next(self._congratulation_cycle)
+            image_path = self.pick_image()
             
             await self.send_message_with_image(congratulation, image_path)
-            logger.info(f"🎉 Congratulation sent for {current_date}")
+            logger.info("🎉 Congratulation sent for %s", current_date)
             
         except Exception as e:
-            logger.error(f"❌ Error handling image message: {e}", exc_info=True)
+            logger.error("❌ Error handling image message: %s", e, exc_info=True)
 
-    async def send_daily_reminder(self):
-        """Send the daily 16:00 reminder"""
+    async def send_anki_reminder(self, messages: Iterator[str], name: str):
+        """Send an Anki reminder unless today's task is already done"""
         current_date = self.get_moscow_time().date()
+        completed = self.is_completed_today()
         
-        logger.info(f"🔔 Daily reminder check for {current_date}")
-        logger.info(f"📊 Status - is_completed_today(): {self.is_completed_today()}")
+        logger.info("🔔 %s check for %s", name, current_date)
+        logger.info("📊 Status - is_completed_today(): %s", completed)
         
         # Check if task already completed today using persistent storage
-        if self.is_completed_today():
-            logger.info(f"✅ Task already completed for {current_date} - skipping 16:00 reminder")
+        if completed:
+            logger.info("✅ Task already completed for %s - skipping %s", current_date, name.lower())
             return
         
-        message = random.choice(self.reminder_messages)
-        available_images = self.get_available_images()
-        image_path = random.choice(available_images) if available_images else None
+        message = next(messages)
+        image_path = self.pick_image()
         
         await self.send_message_with_image(message, image_path)
-        logger.info(f"📅 Daily reminder sent at {self.get_moscow_time()}")
+        logger.info("📅 %s sent at %s", name, self.get_moscow_time())
+
+    async def send_daily_reminder(self):
+        """Send the daily 16:00 reminder"""
+        await self.send_anki_reminder(self._reminder_cycle, "Daily reminder")
 
     async def send_followup_reminder(self):
         """Send the 20:30 follow-up reminder"""
-        current_date = self.get_moscow_time().date()
-        
-        logger.info(f"🔔 Follow-up reminder check for {current_date}")
-        logger.info(f"📊 Status - is_completed_today(): {self.is_completed_today()}")
-        
-        # Check if task already completed today using persistent storage
-        if self.is_completed_today():
-            logger.info(f"✅ Task already completed for {current_date} - skipping 20:30 follow-up")
-            return
-        
-        message = random.choice(self.followup_messages)
-        available_images = self.get_available_images()
-        image_path = random.choice(available_images) if available_images else None
-        
-        await self.send_message_with_image(message, image_path)
-        logger.info(f"📅 Follow-up reminder sent at {self.get_moscow_time()}")
+        await self.send_anki_reminder(self._followup_cycle, "Follow-up reminder")
 
     async def send_article_reminder(self):
         """Send the article homework reminder (Sunday & Thursday at 18:00)"""
-        logger.info(f"📰 Article reminder triggered at {self.get_moscow_time()}")
+        logger.info("📰 Article reminder triggered at %s", self.get_moscow_time())
         
         # Get the next message in rotation
-        message = self.article_messages[self.article_message_index]
-        self.article_message_index = (self.article_message_index + 1) % len(self.article_messages)
+        message = ARTICLE_MESSAGES[self.article_message_index]
+        self.article_message_index = (self.article_message_index + 1) % len(ARTICLE_MESSAGES)
         
         # Send motivational message first
         await self.send_text_message(message)
         logger.info("📝 Article reminder message sent")
         
-        # Wait a moment, then send the link
-        await asyncio.sleep(1)
+        # send_rate_limited keeps the link a second behind the message
         await self.send_text_message(self.article_link)
-        logger.info(f"🔗 Article link sent: {self.article_link}")
-
-    async def reset_daily_flags(self):
-        """Reset daily flags at midnight - now handled by date comparison"""
-        logger.info("🕛 Midnight reset - persistent storage continues to work")
+        logger.info("🔗 Article link sent: %s", self.article_link)
 
     def setup_scheduler(self):
         """Setup the scheduler with cron jobs"""
         # Daily Anki reminder at 16:00 Moscow time
         self.scheduler.add_job(
             self.send_daily_reminder,
-            CronTrigger(hour=16, minute=0, timezone=self.moscow_tz),
+            CronTrigger(hour=16, minute=0, timezone=MOSCOW_TZ),
             id='daily_reminder',
             replace_existing=True
         )
@@ -319,7 +564,7 @@ class SimpleAnkiBot:
         # Follow-up Anki reminder at 20:30 Moscow time
         self.scheduler.add_job(
             self.send_followup_reminder,
-            CronTrigger(hour=20, minute=30, timezone=self.moscow_tz),
+            CronTrigger(hour=20, minute=30, timezone=MOSCOW_TZ),
             id='followup_reminder',
             replace_existing=True
         )
@@ -327,7 +572,7 @@ class SimpleAnkiBot:
         # Article reminder on Sunday at 18:00 Moscow time
         self.scheduler.add_job(
             self.send_article_reminder,
-            CronTrigger(day_of_week='sun', hour=18, minute=0, timezone=self.moscow_tz),
+            CronTrigger(day_of_week='sun', hour=18, minute=0, timezone=MOSCOW_TZ),
             id='article_reminder_sunday',
             replace_existing=True
         )
@@ -335,16 +580,16 @@ class SimpleAnkiBot:
         # Article reminder on Thursday at 18:00 Moscow time
         self.scheduler.add_job(
             self.send_article_reminder,
-            CronTrigger(day_of_week='thu', hour=18, minute=0, timezone=self.moscow_tz),
+            CronTrigger(day_of_week='thu', hour=18, minute=0, timezone=MOSCOW_TZ),
             id='article_reminder_thursday',
             replace_existing=True
         )
         
-        # Midnight check (optional - mainly for logging)
+        # Daily image re-scan at 03:00 Moscow time
         self.scheduler.add_job(
-            self.reset_daily_flags,
-            CronTrigger(hour=0, minute=0, timezone=self.moscow_tz),
-            id='reset_flags',
+            self.refresh_images,
+            CronTrigger(hour=3, minute=0, timezone=MOSCOW_TZ),
+            id='refresh_images',
             replace_existing=True
         )
         
@@ -352,9 +597,8 @@ class SimpleAnkiBot:
 
     async def test_reminder(self):
         """Send a test reminder immediately"""
-        message = "🧪 Test reminder: " + random.choice(self.reminder_messages)
-        available_images = self.get_available_images()
-        image_path = random.choice(available_images) if available_images else None
+        message = TEST_REMINDER_PREFIX + next(self._reminder_cycle)
+        image_path = self.pick_image()
         await self.send_message_with_image(message, image_path)
         logger.info("Test reminder sent")
 
@@ -364,60 +608,92 @@ class SimpleAnkiBot:
         
         try:
             # Create application
-            self.application = Application.builder().token(self.token).build()
+            # Handle updates concurrently so one slow send doesn't hold up the next photo
+            self.application = (
+                Application.builder()
+                .token(self.token)
+                .concurrent_updates(True)
+                .build()
+            )
+            self.bot = self.application.bot
             
-            # Add message handler for images
-            image_handler = MessageHandler(filters.PHOTO, self.handle_image_message)
-            self.application.add_handler(image_handler)
+            if self.monitor_images:
+                # Add message handler for images from the target chat only
+                image_handler = MessageHandler(
+                    filters.PHOTO & filters.Chat(chat_id=self.chat_id),
+                    self.handle_image_message
+                )
+                self.application.add_handler(image_handler)
+                
+                # Record every update's offset before the regular handlers run
+                offset_handler = TypeHandler(Update, self.record_update_offset)
+                self.application.add_handler(offset_handler, group=-1)
             
             # Test bot connection
             me = await self.bot.get_me()
-            logger.info(f"✅ Connected as: {me.username}")
+            logger.info("✅ Connected as: %s", me.username)
             
             # Setup and start scheduler
             self.setup_scheduler()
             self.scheduler.start()
             
             logger.info("✅ Bot started successfully!")
-            logger.info(f"📅 Anki reminders: 16:00 & 20:30 Moscow time")
-            logger.info(f"📰 Article reminders: Sunday & Thursday 18:00 Moscow time")
-            logger.info(f"💬 Monitoring chat ID: {self.chat_id}")
-            logger.info(f"🕐 Current Moscow time: {self.get_moscow_time()}")
-            logger.info(f"🔗 Current article link: {self.article_link}")
+            logger.info("📅 Anki reminders: 16:00 & 20:30 Moscow time")
+            logger.info("📰 Article reminders: Sunday & Thursday 18:00 Moscow time")
+            logger.info("💬 Monitoring chat ID: %s", self.chat_id)
+            logger.info("🕐 Current Moscow time: %s", self.get_moscow_time())
+            logger.info("🔗 Current article link: %s", self.article_link)
             
             # Check for images
             available_images = self.get_available_images()
             if available_images:
-                logger.info(f"📸 Found {len(available_images)} images")
+                logger.info("📸 Found %s images", len(available_images))
             else:
                 logger.info("📸 No images found - will send text-only messages")
             
             # Check persistent storage status
-            status = self.load_completion_status()
-            logger.info(f"💾 Persistent storage status: {len(status)} days recorded")
+            logger.info("💾 Persistent storage status: %s days recorded", len(self._completed))
             
-            # Start polling for messages
-            logger.info("👀 Starting to monitor for student images...")
             await self.application.initialize()
             await self.application.start()
             
             # Send test message on startup
             await self.test_reminder()
             
-            # Keep the bot running and polling for updates
-            logger.info("🔄 Bot is now running and monitoring messages...")
-            await self.application.updater.start_polling()
+            if self.monitor_images:
+                # Acknowledge updates already handled before the last restart
+                offset = self.load_update_offset()
+                if offset is not None:
+                    try:
+                        await self.bot.get_updates(offset=offset, timeout=0)
+                        logger.info("⏩ Resuming from saved update offset %s", offset)
+                    except TelegramError as e:
+                        # Optional step - start_polling retries and the dedup still applies
+                        logger.warning("Could not confirm saved update offset (%s)", e)
+                
+                # Keep the bot running and polling for updates
+                logger.info("👀 Bot is now running and monitoring for student images...")
+                # Only message updates are handled, so don't ask Telegram for anything else
+                await self.application.updater.start_polling(allowed_updates=[Update.MESSAGE])
+            else:
+                logger.info("🔕 Image monitoring disabled - sending reminders only")
             
-            # Keep alive
-            while True:
-                await asyncio.sleep(60)
+            # Keep alive until a shutdown signal arrives
+            await self._shutdown_event.wait()
                 
         except Exception as e:
-            logger.error(f"❌ Error starting bot: {e}")
+            logger.error("❌ Error starting bot: %s", e)
             raise
 
+    def handle_shutdown_signal(self, signum: int):
+        """Handle shutdown signals by letting start_bot return"""
+        logger.info("Received signal %s, shutting down...", signum)
+        self._shutdown_event.set()
+
     async def stop_bot(self):
         """Stop the bot gracefully"""
+        # Release start_bot's keep-alive wait first
+        self._shutdown_event.set()
         logger.info("🛑 Stopping Bot...")
         
         if self.scheduler.running:
@@ -425,46 +701,56 @@ class SimpleAnkiBot:
             logger.info("Scheduler stopped")
         
         if self.application:
-            await self.application.updater.stop()
-            await self.application.stop()
+            # start_bot may have failed before polling or the application started
+            if self.application.updater and self.application.updater.running:
+                await self.application.updater.stop()
+            if self.application.running:
+                await self.application.stop()
             await self.application.shutdown()
             logger.info("Telegram application stopped")
         
         logger.info("Bot stopped gracefully")
 
-# Global bot instance for signal handling
-bot_instance = None
-
-def signal_handler(signum, frame):
-    """Handle shutdown signals"""
-    logger.info(f"Received signal {signum}, shutting down...")
-    if bot_instance:
-        asyncio.create_task(bot_instance.stop_bot())
-    sys.exit(0)
-
 async def main():
     """Main function"""
-    global bot_instance
+    bot_instance = None
+    
+    log_listener.start()
     
     print("🤖 Anki & Article Reminder Bot - Railway Compatible")
     print("=" * 55)
     
-    # Setup signal handlers for graceful shutdown
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
     try:
-        bot_instance = SimpleAnkiBot()
+        monitor_images = os.getenv('MONITOR_IMAGES', 'true').lower() != 'false'
+        bot_instance = SimpleAnkiBot(monitor_images=monitor_images)
+        
+        # Setup signal handlers for graceful shutdown on the running loop
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, bot_instance.handle_shutdown_signal, sig)
+            except NotImplementedError:
+                # Not supported on Windows - Ctrl+C still raises KeyboardInterrupt
+                pass
+        
         await bot_instance.start_bot()
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt")
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)
     finally:
         if bot_instance:
             await bot_instance.stop_bot()
+        log_listener.stop()
 
 if __name__ == "__main__":
+    # Use the faster libuv-based event loop when it's installed
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
     try:
         asyncio.run(main())
     except KeyboardInterrupt: